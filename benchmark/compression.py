@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+#
+# Benchmark of the TXMODEM compressed transfer mode.
+#
+# (C) 2012 Armin Tamzarian
+# This software is distributed under a free software license, see LICENSE
+
+import math
+import os
+import sys
+import time
+
+from txmodem.txmodem import TXMODEM, _ImageDigest
+
+# SOH, block index, inverted block index and CRC-16 framing bytes per block
+_FRAME_OVERHEAD = 5
+
+# start, data and stop bits per byte for 8N1
+_BITS_PER_BYTE = 10
+
+def wire_time(size, baudrate, trailer=False):
+    """
+    Calculates the time in s required to transmit a payload of the given size as XMODEM-CRC blocks.
+
+    :param size: Size of the payload in bytes.
+    :param baudrate: Baud rate of the serial port device.
+    :param trailer: Whether the integrity trailer block follows the payload as in the compressed transfer.
+    """
+    number_of_blocks = int(math.ceil(float(size) / TXMODEM._BLOCK_SIZE))
+    if trailer:
+        number_of_blocks += 1
+    return number_of_blocks * (TXMODEM._BLOCK_SIZE + _FRAME_OVERHEAD) * _BITS_PER_BYTE / float(baudrate)
+
+def compress(filename, level):
+    """
+    Compresses a file along the path of the compressed transfer in :py:meth:`TXMODEM.send`.
+
+    :param filename: Filename of the file to compress.
+    :param level: zlib compression level.
+
+    :returns: A tuple of the compressed payload and the CPU time in s.
+    """
+    tx_object = TXMODEM()
+    tx_object.set_compression(level)
+
+    input_file = open(filename, "rb")
+    try:
+        start = time.clock()
+        payload = "".join(tx_object._compress_blocks(input_file, _ImageDigest(None)))
+        return payload, time.clock() - start
+    finally:
+        input_file.close()
+
+def decompress(payload):
+    """
+    Restores the file from the payload of a compressed transfer as a cooperating receiver.
+
+    :param payload: The compressed payload.
+
+    :returns: The CPU time in s.
+    """
+    start = time.clock()
+    TXMODEM.decompress(payload)
+    return time.clock() - start
+
+def main():
+    if len(sys.argv) not in (2, 3):
+        print "Usage: python benchmark/compression.py [filename] [baudrate]"
+        return 1
+
+    size = os.path.getsize(sys.argv[1])
+    if not size:
+        print "[ERROR] Empty input file '%s'." % (sys.argv[1])
+        return 1
+    baudrate = int(sys.argv[2]) if len(sys.argv) == 3 else 115200
+
+    raw_time = wire_time(size, baudrate)
+    print "%d bytes at %d baud: %.2f s uncompressed (%.1f kB/s)" % (size, baudrate, raw_time, size / raw_time / 1024)
+    print
+    print "level  ratio  tx cpu [s]  rx cpu [s]  wire [s]  total [s]  kB/s     gain"
+    print "-----  -----  ----------  ----------  --------  ---------  -------  -----"
+
+    for level in range(10):
+        payload, tx_time = compress(sys.argv[1], level)
+        rx_time = decompress(payload)
+
+        payload_time = wire_time(len(payload), baudrate, True)
+        total_time = tx_time + payload_time + rx_time
+        print "%5d  %5.2f  %10.3f  %10.3f  %8.2f  %9.2f  %7.1f  %4.2fx" % (
+            level,
+            size / float(len(payload)),
+            tx_time,
+            rx_time,
+            payload_time,
+            total_time,
+            size / total_time / 1024,
+            raw_time / total_time
+        )
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+#
+# Round trip check of the TXMODEM trace and extension wire and file formats.
+#
+# (C) 2012 Armin Tamzarian
+# This software is distributed under a free software license, see LICENSE
+
+import os
+import shutil
+import sys
+import tempfile
+
+from txmodem import *
+
+class CooperatingReceiver:
+    """
+    A pySerial Serial compatible simulation of a cooperating receiver.
+
+    The receiver offers the given initiation signals in turn until the first block arrives, validates the framing of each block and acknowledges it. An empty initiation signal simulates a timeout.
+    """
+
+    _SIGNAL_SOH = chr(1)
+    _SIGNAL_EOT = chr(4)
+    _SIGNAL_ACK = chr(6)
+
+    def __init__(self, signals):
+        """
+        CooperatingReceiver class constructor.
+
+        :param signals: Initiation signals to offer in turn.
+        """
+        self.signals = list(signals)
+        self.signal = None
+        self.blocks = []
+        self.terminated = False
+        self._buffer = ""
+
+    def write(self, data):
+        if data == self._SIGNAL_EOT:
+            self.terminated = True
+        else:
+            block_index, block = ord(data[1]), data[3:-2]
+            if data[0] != self._SIGNAL_SOH or ord(data[2]) != ~block_index & 0xFF:
+                raise AssertionError("Malformed block header.")
+            if block_index != (len(self.blocks) + 1) & 0xFF:
+                raise AssertionError("Unexpected block index %d." % (block_index))
+            if data[-2:] != TXMODEM()._crc_16(block):
+                raise AssertionError("Invalid block checksum.")
+            self.blocks.append(block)
+        self._buffer = self._SIGNAL_ACK
+        return len(data)
+
+    def read(self, size=1):
+        if not self._buffer and not self.blocks and self.signals:
+            self.signal = self.signals.pop(0)
+            self._buffer = self.signal
+        data = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return data
+
+    def inWaiting(self):
+        return len(self._buffer)
+
+    def flush(self):
+        pass
+
+    def isOpen(self):
+        return True
+
+    def close(self):
+        pass
+
+    def payload(self):
+        """
+        Returns the concatenated data of the received blocks preceding the integrity trailer.
+        """
+        return "".join(self.blocks[:-1])
+
+    def trailer(self):
+        """
+        Returns the received integrity trailer block.
+        """
+        return self.blocks[-1]
+
+def check(condition, message):
+    if not condition:
+        raise AssertionError(message)
+
+def send(filename, signals, compression=None, manifest_filename=None, trace_filename=None):
+    """
+    Transfers a file to a simulated cooperating receiver.
+
+    :returns: A tuple of the receiver and the result of :py:meth:`TXMODEM.send`.
+    """
+    receiver = CooperatingReceiver(signals)
+    tx_object = TXMODEM.from_serial(receiver)
+    tx_object.set_compression(compression)
+    tx_object.set_delta(manifest_filename)
+    tx_object.record(trace_filename)
+    result = tx_object.send(filename)
+    check(receiver.terminated, "Transfer not terminated.")
+    return receiver, result
+
+def replay(filename, trace_filename, replay_trace_filename=None, manifest_filename=None):
+    """
+    Transfers a file to the receiver recorded in a trace without delay.
+
+    :param replay_trace_filename: Filename of the trace to record the replayed session to or None.
+
+    :returns: The result of :py:meth:`TXMODEM.send`.
+    """
+    tx_object = TXMODEM.from_serial(ReplaySerial(trace_filename, 0))
+    tx_object.set_delta(manifest_filename)
+    tx_object.record(replay_trace_filename)
+    return tx_object.send(filename)
+
+def write(filename, data):
+    output_file = open(filename, "wb")
+    output_file.write(data)
+    output_file.close()
+
+def read(filename):
+    input_file = open(filename, "rb")
+    data = input_file.read()
+    input_file.close()
+    return data
+
+def written(trace_filename):
+    """
+    Returns the data of the write records of a trace.
+    """
+    trace = read(trace_filename)
+    header = RecordingSerial._RECORD_HEADER
+    offset = len(RecordingSerial.TRACE_MAGIC)
+    writes = []
+    while offset < len(trace):
+        record_type, delta, length = header.unpack_from(trace, offset)
+        offset += header.size
+        if record_type == RecordingSerial.RECORD_WRITE:
+            writes.append(trace[offset:offset + length])
+        offset += length
+    return writes
+
+def check_record_replay(directory, image):
+    filename = os.path.join(directory, "image")
+    trace_filename = os.path.join(directory, "trace")
+    replay_trace_filename = os.path.join(directory, "replay")
+    write(filename, image)
+
+    receiver, result = send(filename, "V", trace_filename=trace_filename)
+    check(replay(filename, trace_filename, replay_trace_filename) == result, "Replayed transfer result mismatch.")
+    check(written(replay_trace_filename) == written(trace_filename), "Replayed transfer mismatch.")
+
+def check_replay_timeout(directory, image):
+    filename = os.path.join(directory, "image")
+    trace_filename = os.path.join(directory, "trace")
+    replay_trace_filename = os.path.join(directory, "replay")
+    write(filename, image)
+
+    receiver, result = send(filename, ["", "V"], trace_filename=trace_filename)
+    check(ReplaySerial(trace_filename, 0).read() == "", "Recorded timeout not replayed as a timeout.")
+    check(replay(filename, trace_filename, replay_trace_filename) == result, "Replayed transfer result mismatch.")
+    check(written(replay_trace_filename) == written(trace_filename), "Replayed transfer mismatch.")
+
+def check_invalid_trace(directory, image):
+    filename = os.path.join(directory, "image")
+    trace_filename = os.path.join(directory, "trace")
+    invalid_filename = os.path.join(directory, "invalid")
+    write(filename, image)
+    send(filename, "C", trace_filename=trace_filename)
+    trace = read(trace_filename)
+
+    # bad magic, truncated record header and truncated record data
+    for invalid_trace in ("XXXX" + trace[4:], trace[:-3], trace[:-1]):
+        write(invalid_filename, invalid_trace)
+        try:
+            ReplaySerial(invalid_filename)
+        except ConfigurationException:
+            continue
+        raise AssertionError("Invalid trace accepted.")
+
+def check_plain(directory, image):
+    filename = os.path.join(directory, "image")
+    write(filename, image)
+
+    receiver, result = send(filename, "V")
+    check(len(receiver.blocks) == (len(image) + 127) / 128 + 1, "Plain transfer block count mismatch.")
+    check(receiver.payload()[:len(image)] == image, "Plain transfer payload mismatch.")
+    check(TXMODEM.verify(receiver.payload(), receiver.trailer()) == result, "Plain transfer verification mismatch.")
+
+def check_compressed(directory, image):
+    filename = os.path.join(directory, "image")
+    write(filename, image)
+
+    receiver, result = send(filename, "ZC", compression=6)
+    check(receiver.signal == "Z", "Compressed transfer not negotiated.")
+    data = TXMODEM.decompress(receiver.payload())
+    check(data == image, "Compressed transfer payload mismatch.")
+    check(TXMODEM.verify(data, receiver.trailer()) == result, "Compressed transfer verification mismatch.")
+
+def check_compressed_declined(directory, image):
+    filename = os.path.join(directory, "image")
+    write(filename, image)
+
+    receiver, result = send(filename, "ZC")
+    check(receiver.signal == "C", "Compressed transfer not declined without a compression level.")
+    check("".join(receiver.blocks)[:len(image)] == image, "Declined transfer payload mismatch.")
+
+def check_delta(directory, previous_image, image):
+    device_filename = os.path.join(directory, "device")
+    filename = os.path.join(directory, "image")
+    manifest_filename = os.path.join(directory, "manifest")
+    write(device_filename, previous_image)
+    write(filename, image)
+
+    # manifest cache round trip
+    Manifest.from_image(device_filename, 128).save(manifest_filename)
+    manifest = Manifest.load(manifest_filename)
+    check(manifest.size == len(previous_image), "Manifest size mismatch.")
+    check(manifest.digests == Manifest.from_image(device_filename, 128).digests, "Manifest digest mismatch.")
+
+    receiver, result = send(filename, "DC", manifest_filename=manifest_filename)
+    check(receiver.signal == "D", "Delta transfer not negotiated.")
+    TXMODEM.patch(device_filename, receiver.payload())
+    data = read(device_filename)
+    check(data == image, "Patched image mismatch.")
+    check(TXMODEM.verify(data, receiver.trailer()) == result, "Delta transfer verification mismatch.")
+
+    # the manifest of the transferred image is cached for the next transfer
+    check(Manifest.load(manifest_filename).digests == Manifest.from_image(filename, 128).digests, "Cached manifest mismatch.")
+
+def check_delta_replay(directory, previous_image, image):
+    device_filename = os.path.join(directory, "device")
+    filename = os.path.join(directory, "image")
+    manifest_filename = os.path.join(directory, "manifest")
+    trace_filename = os.path.join(directory, "trace")
+    write(device_filename, previous_image)
+    write(filename, image)
+    Manifest.from_image(device_filename, 128).save(manifest_filename)
+    previous_manifest = read(manifest_filename)
+
+    send(filename, "DC", manifest_filename=manifest_filename, trace_filename=trace_filename)
+
+    # the replayed device never receives the image so its cached manifest must remain untouched
+    write(manifest_filename, previous_manifest)
+    replay(filename, trace_filename, manifest_filename=manifest_filename)
+    check(read(manifest_filename) == previous_manifest, "Manifest cached by a replayed transfer.")
+
+def check_delta_fallback(directory, image):
+    filename = os.path.join(directory, "image")
+    manifest_filename = os.path.join(directory, "missing")
+    write(filename, image)
+
+    receiver, result = send(filename, "DC", manifest_filename=manifest_filename)
+    check(receiver.signal == "C", "Delta transfer not declined without a manifest.")
+    check("".join(receiver.blocks)[:len(image)] == image, "Fallback transfer payload mismatch.")
+    check(Manifest.load(manifest_filename).size == len(image), "Manifest not cached after fallback transfer.")
+
+def check_manifest_cache_failure(directory, image):
+    filename = os.path.join(directory, "image")
+    manifest_filename = os.path.join(directory, "missing", "manifest")
+    write(filename, image)
+
+    # a manifest which cannot be cached must not fail the completed transfer
+    receiver, result = send(filename, "DC", manifest_filename=manifest_filename)
+    check("".join(receiver.blocks)[:len(image)] == image, "Transfer payload mismatch on a failed manifest cache.")
+    check(result["size"] == len(image), "Transfer result lost on a failed manifest cache.")
+
+def main():
+    # sizes which are not a multiple of the block size
+    image = os.urandom(128 * 40 + 50)
+    changed_image = image[:200] + chr(ord(image[200]) ^ 0xFF) + image[201:] + os.urandom(300)
+    shorter_image = image[:128 * 25 + 17]
+
+    checks = [
+        ("record and replay",          lambda directory: check_record_replay(directory, image)),
+        ("replay of a timeout",        lambda directory: check_replay_timeout(directory, image)),
+        ("invalid trace",              lambda directory: check_invalid_trace(directory, image)),
+        ("plain transfer",             lambda directory: check_plain(directory, image)),
+        ("plain empty transfer",       lambda directory: check_plain(directory, "")),
+        ("compressed transfer",        lambda directory: check_compressed(directory, image * 4)),
+        ("compression declined",       lambda directory: check_compressed_declined(directory, image)),
+        ("delta to longer image",      lambda directory: check_delta(directory, image, changed_image)),
+        ("delta to shorter image",     lambda directory: check_delta(directory, image, shorter_image)),
+        ("delta to unchanged image",   lambda directory: check_delta(directory, image, image)),
+        ("delta replay",               lambda directory: check_delta_replay(directory, image, changed_image)),
+        ("delta fallback",             lambda directory: check_delta_fallback(directory, image)),
+        ("manifest cache failure",     lambda directory: check_manifest_cache_failure(directory, image)),
+    ]
+
+    failures = 0
+    for name, function in checks:
+        directory = tempfile.mkdtemp()
+        try:
+            function(directory)
+            print "[ OK ] %s" % (name)
+        except (AssertionError, ExceptionTXMODEM) as ex:
+            print "[FAIL] %s: %s" % (name, ex)
+            failures += 1
+        finally:
+            shutil.rmtree(directory)
+
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -6,10 +6,14 @@
 # This software is distributed under a free software license, see LICENSE
 
 import getopt
+import hashlib
 import math
 import os
 import re
+import struct
 import sys
+import time
+import zlib
 
 from serial import *
 from serial.tools import list_ports
@@ -41,6 +45,396 @@ class UnexpectedSignalException(ExceptionTXMODEM):
     def get_signal(self):
         return self._signal
 
+class RecordingSerial:
+    """
+    A pySerial Serial compatible wrapper which records every ``write`` and ``read`` exchanged with the receiver to a compact binary trace file.
+    
+    The trace consists of a :py:const:`TRACE_MAGIC` header followed by records of the form ``<type:uint8><delta:uint32><length:uint16><data>`` where *delta* is the number of microseconds elapsed since the previous record.
+    
+    .. note:: Reads which drain bytes already reported by ``inWaiting`` are folded into the preceding read record so a multi-byte response is replayed as a single unit.
+    """
+    
+    TRACE_MAGIC  = "TXMT\x01"
+    
+    RECORD_WRITE = 1
+    RECORD_READ  = 2
+    
+    _RECORD_HEADER = struct.Struct("<BIH")
+    _MAXIMUM_DELTA = 0xFFFFFFFF
+    _MAXIMUM_DATA  = 0xFFFF
+    
+    def __init__(self, serial, trace_filename):
+        """
+        RecordingSerial class constructor.
+        
+        :param serial: The pySerial Serial object to wrap.
+        :param trace_filename: Filename of the trace file to create.
+        
+        :raises ConfigurationException: Will be raised in the event the trace file cannot be created.
+        """
+        self.serial = serial
+        
+        try:
+            self._trace_file = open(trace_filename, "wb")
+        except IOError:
+            raise ConfigurationException("Unable to create trace filename '%s'." % (trace_filename))
+        self._trace_file.write(self.TRACE_MAGIC)
+        
+        self._last_time = time.time()
+        self._pending_read = None
+        self._draining = False
+    
+    def __getattr__(self, name):
+        return getattr(self.serial, name)
+    
+    def write(self, data):
+        """
+        Records and writes data to the wrapped port.
+        
+        :param data: Data to write.
+        """
+        self._flush_pending_read()
+        self._write_record(self.RECORD_WRITE, time.time(), data)
+        self._draining = False
+        return self.serial.write(data)
+    
+    def read(self, size=1):
+        """
+        Reads and records data from the wrapped port.
+        
+        :param size: Maximum number of bytes to read.
+        """
+        data = self.serial.read(size)
+        if self._draining and self._pending_read is not None:
+            self._pending_read[1] += data
+        else:
+            self._flush_pending_read()
+            self._pending_read = [time.time(), data]
+        self._draining = False
+        return data
+    
+    def inWaiting(self):
+        """
+        Returns the number of bytes waiting to be read from the wrapped port.
+        """
+        waiting = self.serial.inWaiting()
+        self._draining = waiting > 0
+        return waiting
+    
+    def close(self):
+        """
+        Closes the trace file and the wrapped port.
+        """
+        self.close_trace()
+        self.serial.close()
+    
+    def close_trace(self):
+        """
+        Writes any outstanding record and closes the trace file without closing the wrapped port.
+        """
+        if self._trace_file is not None:
+            self._flush_pending_read()
+            self._trace_file.close()
+            self._trace_file = None
+    
+    def _flush_pending_read(self):
+        """
+        Writes the read record currently being accumulated, if any, to the trace file.
+        """
+        if self._pending_read is not None:
+            self._write_record(self.RECORD_READ, *self._pending_read)
+            self._pending_read = None
+    
+    def _write_record(self, record_type, timestamp, data):
+        """
+        Writes a single record to the trace file.
+        
+        :param record_type: Type of the record which should be one of :py:const:`RECORD_WRITE` or :py:const:`RECORD_READ`.
+        :param timestamp: Time at which the recorded operation occurred.
+        :param data: Data written or read by the recorded operation.
+        """
+        delta = int(max(timestamp - self._last_time, 0) * 1000000)
+        self._last_time = timestamp
+        
+        data = data[:self._MAXIMUM_DATA]
+        self._trace_file.write(self._RECORD_HEADER.pack(record_type, min(delta, self._MAXIMUM_DELTA), len(data)))
+        self._trace_file.write(data)
+
+class ReplaySerial:
+    """
+    A pySerial Serial compatible transport which feeds the receiver side of a trace recorded by :py:class:`RecordingSerial` back into :py:meth:`TXMODEM.send`.
+    
+    Written data is discarded so that protocol changes may be benchmarked against the recorded response and latency patterns.
+    """
+    
+    def __init__(self, trace_filename, scale=1.0):
+        """
+        ReplaySerial class constructor.
+        
+        :param trace_filename: Filename of the trace file to replay.
+        :param scale: Factor applied to the recorded response latencies. A value of 0 replays without delay.
+        
+        :raises ConfigurationException: Will be raised in the event of an inaccessible or invalid trace file.
+        """
+        if scale < 0:
+            raise ConfigurationException("Invalid replay scale '%s' specified." % (scale))
+        
+        self.scale = scale
+        self.timeout = None
+        
+        self._responses = self._load(trace_filename)
+        self._buffer = ""
+        self._open = True
+    
+    def _load(self, trace_filename):
+        """
+        Loads the read records of a trace file.
+        
+        :param trace_filename: Filename of the trace file to load.
+        
+        :returns: A list of *(latency, data)* tuples where *latency* is the time in s between the read and the preceding record.
+        """
+        try:
+            trace_file = open(trace_filename, "rb")
+        except IOError:
+            raise ConfigurationException("Unable to access trace filename '%s'." % (trace_filename))
+        
+        header = RecordingSerial._RECORD_HEADER
+        responses = []
+        try:
+            if trace_file.read(len(RecordingSerial.TRACE_MAGIC)) != RecordingSerial.TRACE_MAGIC:
+                raise ConfigurationException("Invalid trace file '%s'." % (trace_filename))
+            
+            while True:
+                record = trace_file.read(header.size)
+                if not record:
+                    break
+                if len(record) < header.size:
+                    raise ConfigurationException("Truncated trace file '%s'." % (trace_filename))
+                
+                record_type, delta, length = header.unpack(record)
+                data = trace_file.read(length)
+                if len(data) < length:
+                    raise ConfigurationException("Truncated trace file '%s'." % (trace_filename))
+                if record_type == RecordingSerial.RECORD_READ:
+                    responses.append((delta / 1000000.0, data))
+        finally:
+            trace_file.close()
+        
+        responses.reverse()
+        return responses
+    
+    def write(self, data):
+        """
+        Discards written data.
+        
+        :param data: Data to write.
+        """
+        return len(data)
+    
+    def read(self, size=1):
+        """
+        Reads data from the next recorded response after its scaled latency once the previous response has been consumed.
+        
+        :param size: Maximum number of bytes to read.
+        """
+        if not self._buffer and self._responses:
+            latency, self._buffer = self._responses.pop()
+            if self.scale > 0:
+                time.sleep(latency * self.scale)
+        
+        data = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return data
+    
+    def inWaiting(self):
+        """
+        Returns the number of bytes remaining of the current recorded response.
+        """
+        return len(self._buffer)
+    
+    def flush(self):
+        """
+        Exists for compatibility. Ignored.
+        """
+        pass
+    
+    def isOpen(self):
+        """
+        Returns whether the transport has not been closed.
+        """
+        return self._open
+    
+    def close(self):
+        """
+        Closes the transport.
+        """
+        self._open = False
+
+class Manifest:
+    """
+    Per-block digests of an image used to determine the blocks which changed between two images for the delta transfer.
+    
+    Manifests may be cached via :py:meth:`save` and :py:meth:`load`. The manifest file consists of a :py:const:`MANIFEST_MAGIC` header, the block size as uint16 and the image size as uint64 followed by the SHA-1 digest of each block.
+    """
+    
+    MANIFEST_MAGIC = "TXMF\x01"
+    
+    _HEADER = struct.Struct("<HQ")
+    _DIGEST_SIZE = hashlib.sha1().digest_size
+    
+    def __init__(self, block_size):
+        """
+        Manifest class constructor for an empty image.
+        
+        :param block_size: Size of the blocks for which the digests are calculated.
+        """
+        self.block_size = block_size
+        self.size = 0
+        self.digests = []
+    
+    @classmethod
+    def from_image(cls, filename, block_size):
+        """
+        Class level static method for constructing the manifest of an image file.
+        
+        :param filename: Filename of the image.
+        :param block_size: Size of the blocks for which the digests are calculated.
+        
+        :raises ConfigurationException: Will be raised in the event of an inaccessible image file.
+        """
+        try:
+            image_file = open(filename, "rb")
+        except IOError:
+            raise ConfigurationException("Unable to access image filename '%s'." % (filename))
+        
+        cls_obj = cls(block_size)
+        try:
+            for block in iter(lambda: image_file.read(block_size), ""):
+                cls_obj.update(block)
+        finally:
+            image_file.close()
+        return cls_obj
+    
+    @classmethod
+    def load(cls, filename):
+        """
+        Class level static method for loading a cached manifest.
+        
+        :param filename: Filename of the manifest file.
+        
+        :raises ConfigurationException: Will be raised in the event of an inaccessible or invalid manifest file.
+        """
+        try:
+            manifest_file = open(filename, "rb")
+        except IOError:
+            raise ConfigurationException("Unable to access manifest filename '%s'." % (filename))
+        
+        try:
+            data = manifest_file.read()
+        finally:
+            manifest_file.close()
+        
+        offset = len(cls.MANIFEST_MAGIC) + cls._HEADER.size
+        if len(data) < offset or not data.startswith(cls.MANIFEST_MAGIC):
+            raise ConfigurationException("Invalid manifest file '%s'." % (filename))
+        
+        block_size, size = cls._HEADER.unpack_from(data, len(cls.MANIFEST_MAGIC))
+        number_of_blocks = int(math.ceil(float(size) / block_size)) if block_size else -1
+        if len(data) != offset + number_of_blocks * cls._DIGEST_SIZE:
+            raise ConfigurationException("Invalid manifest file '%s'." % (filename))
+        
+        cls_obj = cls(block_size)
+        cls_obj.size = size
+        cls_obj.digests = [data[i:i + cls._DIGEST_SIZE] for i in range(offset, len(data), cls._DIGEST_SIZE)]
+        return cls_obj
+    
+    def save(self, filename):
+        """
+        Caches the manifest to a file.
+        
+        :param filename: Filename of the manifest file to create.
+        
+        :raises ConfigurationException: Will be raised in the event the manifest file cannot be created.
+        """
+        try:
+            manifest_file = open(filename, "wb")
+        except IOError:
+            raise ConfigurationException("Unable to create manifest filename '%s'." % (filename))
+        
+        try:
+            manifest_file.write(self.MANIFEST_MAGIC)
+            manifest_file.write(self._HEADER.pack(self.block_size, self.size))
+            manifest_file.write("".join(self.digests))
+        finally:
+            manifest_file.close()
+    
+    def update(self, data):
+        """
+        Appends the digests of the blocks of the given data to the manifest.
+        
+        :param data: Data following the data previously added. Only the final call may supply a partial block.
+        """
+        if self.size % self.block_size:
+            raise ConfigurationException("Unable to append to a manifest ending in a partial block.")
+        
+        for i in range(0, len(data), self.block_size):
+            self.digests.append(hashlib.sha1(data[i:i + self.block_size]).digest())
+        self.size += len(data)
+    
+    def changed_blocks(self, previous):
+        """
+        Determines the blocks which differ from those of a previous image.
+        
+        :param previous: Manifest of the previous image.
+        
+        :returns: A list of the indices of the changed blocks.
+        
+        :raises ConfigurationException: Will be raised in the event the block sizes of the manifests differ.
+        """
+        if self.block_size != previous.block_size:
+            raise ConfigurationException("Manifest block sizes differ.")
+        
+        return [i for i, digest in enumerate(self.digests) if i >= len(previous.digests) or digest != previous.digests[i]]
+
+class _ImageDigest:
+    """
+    Size, CRC-32 and SHA-256 digests and optionally the manifest of an image accumulated as it is read for the transfer.
+    """
+    
+    def __init__(self, manifest):
+        """
+        _ImageDigest class constructor.
+        
+        :param manifest: Empty manifest to accumulate along with the digests or None.
+        """
+        self.manifest = manifest
+        self.size = 0
+        self.crc32 = 0
+        self.sha256 = hashlib.sha256()
+    
+    def update(self, data):
+        """
+        Appends data of the image to the digests.
+        
+        :param data: Data following the data previously added. Only the final call may supply a partial block.
+        """
+        self.size += len(data)
+        self.crc32 = zlib.crc32(data, self.crc32)
+        self.sha256.update(data)
+        if self.manifest is not None:
+            self.manifest.update(data)
+    
+    def result(self):
+        """
+        Returns the digests in the form returned by :py:meth:`TXMODEM.send`.
+        """
+        return {
+            "size"   : self.size,
+            "crc32"  : self.crc32 & 0xFFFFFFFF,
+            "sha256" : self.sha256.hexdigest()
+        }
+
 class TXMODEM:
     """
     A Python class implementing the XMODEM and XMODEM-CRC send protocol built on top of `pySerial <http://pyserial.sourceforge.net/>`_.
@@ -56,11 +450,23 @@ class TXMODEM:
     _SIGNAL_CAN   = chr(24)
     _SIGNAL_CRC16 = chr(67)
     
+    # TXMODEM extension signals for cooperating receivers
+    _SIGNAL_ZLIB  = chr(90)
+    _SIGNAL_DELTA = chr(68)
+    _SIGNAL_VERIFY = chr(86)
+    
     _BLOCK_SIZE   = 128
     _RETRY_COUNT  = 10
     
+    # maximum number of declined extension signals to ignore per initiation attempt
+    _DECLINE_COUNT = 100
+    
     _PADDING_BYTE = chr(26)
     
+    # integrity trailer sent to cooperating receivers after the last block
+    _TRAILER_MAGIC = "TXMV"
+    _TRAILER       = struct.Struct(">4sQI32s")
+    
     # default port configurations
     _configuration = {
         "port"     : None,
@@ -76,6 +482,23 @@ class TXMODEM:
     
     # checksum calculation function
     _checksum = None
+    
+    # filename of the trace to record the session to
+    _trace_filename = None
+    
+    # zlib compression level offered to cooperating receivers and whether it was negotiated
+    _compression_level = None
+    _compressed = False
+    
+    # filename of the cached manifest of the receiver's image and whether the delta transfer was negotiated
+    _manifest_filename = None
+    _delta = False
+    
+    # manifest of the receiver's image loaded when the delta transfer was negotiated
+    _previous_manifest = None
+    
+    # whether the integrity trailer is to be sent
+    _trailer = False
 
     # hooks for event callbacks
     EVENT_INITIALIZATION = 0
@@ -137,6 +560,129 @@ class TXMODEM:
         :param event_type: Type of the event which should be one of the types: :py:const:`EVENT_INITIALIZATION`, :py:const:`EVENT_BLOCK_SENT`, or :py:const:`EVENT_TERMIATION`
         """
         self._event_callbacks[event_type].append(callback)
+    
+    def record(self, trace_filename):
+        """
+        Record the byte exchange of subsequent calls to :py:meth:`send` to a trace file which may be replayed via :py:class:`ReplaySerial`.
+        
+        :param trace_filename: Filename of the trace file to create or None to disable recording.
+        """
+        self._trace_filename = trace_filename
+    
+    def set_delta(self, manifest_filename):
+        """
+        Offer a delta transfer to cooperating receivers for subsequent calls to :py:meth:`send`.
+        
+        A cooperating receiver requests the delta transfer by initiating with ``D`` instead of ``C``. If a valid manifest of the image held by the receiver with a matching block size is cached the transfer then proceeds as XMODEM-CRC with the blocks carrying a header followed by only the blocks which changed, which the receiver patches into place via :py:meth:`patch`, and the integrity trailer described in :py:meth:`verify` as the last block. Otherwise the ``D`` is ignored so that the receiver falls back to a full transfer.
+        
+        The header consists of ``filename NUL size block_size count NUL`` followed by the byte offsets of the *count* changed blocks as big-endian uint32 and is padded to a multiple of the block size.
+        
+        After each successful transfer other than a replay via :py:class:`ReplaySerial` the manifest of the transferred file is cached to *manifest_filename*.
+        
+        :param manifest_filename: Filename of the cached manifest or None to disable the delta transfer.
+        """
+        self._manifest_filename = manifest_filename
+    
+    @staticmethod
+    def patch(image_filename, payload):
+        """
+        Patches the blocks received in a delta transfer into place.
+        
+        :param image_filename: Filename of the image held by the receiver.
+        :param payload: Concatenated data of the received blocks including the trailing padding but excluding the last block, which is the integrity trailer to be passed to :py:meth:`verify`.
+        
+        :raises ConfigurationException: Will be raised in the event of an inaccessible image file.
+        :raises CommunicationException: Will be raised in the event of a malformed payload.
+        """
+        try:
+            name_end = payload.index("\0")
+            fields_end = payload.index("\0", name_end + 1)
+            size, block_size, count = map(int, payload[name_end + 1:fields_end].split())
+        except ValueError:
+            raise CommunicationException("Malformed delta header received.")
+        if block_size <= 0 or count < 0:
+            raise CommunicationException("Malformed delta header received.")
+        
+        offsets_start = fields_end + 1
+        blocks_start = int(math.ceil(float(offsets_start + count * 4) / block_size)) * block_size
+        if len(payload) < blocks_start + count * block_size:
+            raise CommunicationException("Truncated delta payload received.")
+        offsets = struct.unpack(">%dI" % (count), payload[offsets_start:offsets_start + count * 4])
+        
+        try:
+            image_file = open(image_filename, "r+b")
+        except IOError:
+            raise ConfigurationException("Unable to access image filename '%s'." % (image_filename))
+        
+        try:
+            for i, offset in enumerate(offsets):
+                image_file.seek(offset)
+                image_file.write(payload[blocks_start + i * block_size:blocks_start + (i + 1) * block_size])
+            image_file.truncate(size)
+        finally:
+            image_file.close()
+    
+    @staticmethod
+    def verify(data, trailer):
+        """
+        Verifies the file received from a cooperating receiver's transfer against the integrity trailer.
+        
+        A cooperating receiver which initiated with ``Z``, ``D`` or ``V`` receives the integrity trailer as an additional block after the last block of the transfer. The trailer consists of ``TXMV``, the size of the file as uint64, its CRC-32 as uint32 and its SHA-256 digest, all big-endian and padded to the block size. A receiver initiating with ``V`` receives the plain file as in XMODEM-CRC followed by the trailer.
+        
+        :param data: The received file after :py:meth:`decompress` or :py:meth:`patch` where applicable. The padding of the last block of a plain transfer is discarded.
+        :param trailer: The received trailer block.
+        
+        :returns: A dictionary with the ``size``, ``crc32`` and hexadecimal ``sha256`` digests of the file.
+        
+        :raises CommunicationException: Will be raised in the event of a malformed trailer or a file which does not match the trailer.
+        """
+        if len(trailer) < TXMODEM._TRAILER.size:
+            raise CommunicationException("Malformed integrity trailer received.")
+        
+        magic, size, crc32, sha256 = TXMODEM._TRAILER.unpack_from(trailer)
+        if magic != TXMODEM._TRAILER_MAGIC:
+            raise CommunicationException("Malformed integrity trailer received.")
+        
+        if len(data) > size and len(data) - size < TXMODEM._BLOCK_SIZE and data[size:] == TXMODEM._PADDING_BYTE * (len(data) - size):
+            data = data[:size]
+        if len(data) != size or zlib.crc32(data) & 0xFFFFFFFF != crc32 or hashlib.sha256(data).digest() != sha256:
+            raise CommunicationException("Integrity verification of the received file failed.")
+        
+        return {
+            "size"   : size,
+            "crc32"  : crc32,
+            "sha256" : sha256.encode("hex")
+        }
+    
+    def set_compression(self, level):
+        """
+        Offer a zlib compressed transfer to cooperating receivers for subsequent calls to :py:meth:`send`.
+        
+        A cooperating receiver requests the compressed transfer by initiating with ``Z`` instead of ``C``. The transfer then proceeds as XMODEM-CRC with the blocks carrying the zlib stream of the file, which the receiver restores via :py:meth:`decompress`, and the integrity trailer described in :py:meth:`verify` as the last block. Receivers initiating with ``NAK`` or ``C`` receive the plain file.
+        
+        .. note:: As the compressed size is not known in advance the *number_of_blocks* reported to :py:const:`EVENT_BLOCK_SENT` callbacks during a compressed transfer is the number of blocks of the uncompressed file, or the number of blocks sent so far if greater.
+        
+        :param level: zlib compression level from 0 to 9 or None to disable the compressed transfer.
+        
+        :raises ConfigurationException: Will be raised in the event of an invalid compression level.
+        """
+        if level is not None and level not in range(10):
+            raise ConfigurationException("Invalid compression level '%s' specified." % (level))
+        self._compression_level = level
+    
+    @staticmethod
+    def decompress(payload):
+        """
+        Restores the file from the received blocks of a compressed transfer.
+        
+        :param payload: Concatenated data of the received blocks including the trailing padding but excluding the last block, which is the integrity trailer to be passed to :py:meth:`verify`.
+        
+        :raises CommunicationException: Will be raised in the event of a corrupt or truncated payload.
+        """
+        try:
+            return zlib.decompress(payload)
+        except zlib.error:
+            raise CommunicationException("Corrupt or truncated compressed payload received.")
         
     def send(self, filename):
         """
@@ -144,6 +690,8 @@ class TXMODEM:
         
         :param filename: Filename of the file to transfer.
         
+        :returns: A dictionary with the ``size``, ``crc32`` and hexadecimal ``sha256`` digests of the transferred file calculated during the transfer.
+        
         :raises ConfigurationException: Will be raised in the event of an invalid file or port configuration parameter.
         :raises CommunicationException: Will be raised in the event of an unrecoverable serial communication error.
         """
@@ -172,28 +720,81 @@ class TXMODEM:
             except ValueError:
                 raise ConfigurationException("Invalid value for configuration parameters.")
             except SerialException:
-                raise ConfigurationException("Unable to open serial device '%s' with specified parameters." % (configuration["port"]))
+                raise ConfigurationException("Unable to open serial device '%s' with specified parameters." % (self._configuration["port"]))
+        
+        # Wrap the serial device if the session is to be recorded
+        if self._trace_filename is not None:
+            try:
+                self._port = RecordingSerial(self._port, self._trace_filename)
+            except ConfigurationException:
+                input_file.close()
+                if create_port:
+                    self._port.close()
+                    self._port = None
+                raise
 
         try:            
             self._port.flush()
-            self._execute_communication(self._initiate_transmission, "Unable to receive initial NAK.")            
+            self._compressed = False
+            self._delta = False
+            self._previous_manifest = None
+            self._trailer = False
+            self._execute_communication(self._initiate_transmission, "Unable to receive initial NAK.")
+            
+            manifest = None
+            if self._manifest_filename is not None:
+                manifest = Manifest(self._BLOCK_SIZE)
+            
+            # digests of the image accumulated as it is read for the transfer
+            digest = _ImageDigest(manifest)
+            
+            number_of_blocks = int(math.ceil(float(os.path.getsize(filename)) / self._BLOCK_SIZE))
+            if self._delta:
+                # the changed blocks are only known once the whole file has been hashed
+                for block in self._read_blocks(input_file, digest):
+                    pass
+                changed_blocks = manifest.changed_blocks(self._previous_manifest)
+                header = self._delta_header(filename, manifest.size, changed_blocks)
+                number_of_blocks = len(header) / self._BLOCK_SIZE + len(changed_blocks)
+                blocks = self._delta_blocks(input_file, header, changed_blocks)
+            elif self._compressed:
+                blocks = self._compress_blocks(input_file, digest)
+            else:
+                blocks = self._read_blocks(input_file, digest)
 
-            number_of_blocks = int(math.ceil(os.path.getsize(filename) / self._BLOCK_SIZE))
-            for i in range(1, number_of_blocks + 1):
-                block = input_file.read(self._BLOCK_SIZE)
-                if block:
-                    if len(block) < self._BLOCK_SIZE:
-                        block += self._PADDING_BYTE * (self._BLOCK_SIZE - len(block))
-                    self._execute_communication(self._transmit_block, "Maximum number of transmission retries exceeded.", **{"block_index": i, "block": block})            
-                    self._trigger_callbacks(self.EVENT_BLOCK_SENT, **{"block_index" : i, "number_of_blocks" : number_of_blocks})
+            block_index = 0
+            for block_index, block in enumerate(blocks, 1):
+                if len(block) < self._BLOCK_SIZE:
+                    block += self._PADDING_BYTE * (self._BLOCK_SIZE - len(block))
+                number_of_blocks = max(number_of_blocks, block_index)
+                self._execute_communication(self._transmit_block, "Maximum number of transmission retries exceeded.", **{"block_index": block_index, "block": block})            
+                self._trigger_callbacks(self.EVENT_BLOCK_SENT, **{"block_index" : block_index, "number_of_blocks" : number_of_blocks})
+            
+            result = digest.result()
+            
+            if self._trailer:
+                trailer = self._TRAILER.pack(self._TRAILER_MAGIC, result["size"], result["crc32"], digest.sha256.digest())
+                trailer += self._PADDING_BYTE * (self._BLOCK_SIZE - len(trailer))
+                self._execute_communication(self._transmit_block, "Maximum number of transmission retries exceeded.", **{"block_index": block_index + 1, "block": trailer})
                     
             self._execute_communication(self._terminate_transmission, "Maximum number of termination retries exceeded.")
+            
+            # The receiver now holds the transferred image unless the session is a replay
+            port = self._port.serial if isinstance(self._port, RecordingSerial) else self._port
+            if manifest is not None and not isinstance(port, ReplaySerial):
+                self._cache_manifest(manifest)
+            
+            return result
         except IOError:
             raise CommunicationException("Unexpected IO error.")
         finally:
             # Always remember to clean up after yourself
             input_file.close()
             
+            if isinstance(self._port, RecordingSerial):
+                self._port.close_trace()
+                self._port = self._port.serial
+            
             if create_port and self._port is not None and self._port.isOpen():
                 self._port.close()
                 self._port = None
@@ -223,6 +824,52 @@ class TXMODEM:
         :param buffer: Exists for compatibility. Ignored.
         """
         self._checksum = self._crc_16
+    
+    def _set_delta(self, buffer):
+        """
+        Sets the _checksum calculation to _crc_16 and enables the delta transfer for compatibility with _wait_for_signal.
+        
+        :param buffer: Exists for compatibility. Ignored.
+        
+        :returns: False if the delta transfer has not been enabled or no usable manifest is cached so that the signal is declined.
+        """
+        if self._manifest_filename is None or not os.path.isfile(self._manifest_filename):
+            return False
+        
+        try:
+            manifest = Manifest.load(self._manifest_filename)
+        except ConfigurationException:
+            return False
+        if manifest.block_size != self._BLOCK_SIZE:
+            return False
+        
+        self._previous_manifest = manifest
+        self._checksum = self._crc_16
+        self._delta = True
+        self._trailer = True
+    
+    def _set_zlib(self, buffer):
+        """
+        Sets the _checksum calculation to _crc_16 and enables the compressed transfer for compatibility with _wait_for_signal.
+        
+        :param buffer: Exists for compatibility. Ignored.
+        
+        :returns: False if the compressed transfer has not been enabled so that the signal is declined.
+        """
+        if self._compression_level is None:
+            return False
+        self._checksum = self._crc_16
+        self._compressed = True
+        self._trailer = True
+    
+    def _set_verify(self, buffer):
+        """
+        Sets the _checksum calculation to _crc_16 and enables the integrity trailer for compatibility with _wait_for_signal.
+        
+        :param buffer: Exists for compatibility. Ignored.
+        """
+        self._checksum = self._crc_16
+        self._trailer = True
         
     def _crc_8(self, block):
         """
@@ -253,6 +900,8 @@ class TXMODEM:
         Waits for a signal to be received and executes a specified callback function.
         
         :param signals: A dictionary with expected signals for keys and callback functions for values of the signature *function(buffer)*. 
+        
+        :returns: The return value of the executed callback function or None.
         """
         buffer = self._port.read()
         while self._port.inWaiting():
@@ -263,7 +912,7 @@ class TXMODEM:
             raise TimeoutException("Communication timeout expired.")
         elif buffer[0] in signals.keys():
             if signals[buffer[0]] is not None:
-                signals[buffer[0]](buffer)
+                return signals[buffer[0]](buffer)
         else:
             raise UnexpectedSignalException("Unexpected communication signal received.", buffer)
 
@@ -290,15 +939,101 @@ class TXMODEM:
     def _initiate_transmission(self):
         """
         Initiates the transmission while automatically selecting between XMODEM and XMODEM-CRC modes.
+        
+        Declined extension signals are ignored while awaiting the receiver's next initiation signal without counting as a failed attempt.
         """
         try:
-            self._wait_for_signal({
-                 self._SIGNAL_NAK : self._set_crc_8,
-                 self._SIGNAL_CRC16 : self._set_crc_16
-            })
-            self._trigger_callbacks(self.EVENT_INITIALIZATION)
+            for decline in range(self._DECLINE_COUNT):
+                accepted = self._wait_for_signal({
+                     self._SIGNAL_NAK : self._set_crc_8,
+                     self._SIGNAL_CRC16 : self._set_crc_16,
+                     self._SIGNAL_ZLIB : self._set_zlib,
+                     self._SIGNAL_DELTA : self._set_delta,
+                     self._SIGNAL_VERIFY : self._set_verify
+                })
+                if accepted is not False:
+                    self._trigger_callbacks(self.EVENT_INITIALIZATION)
+                    return
         except UnexpectedSignalException as ex:
             raise CommunicationException("Unknown initiation signal received.")    
+        
+        raise CommunicationException("Only declined extension initiation signals received.")
+    
+    def _read_blocks(self, input_file, digest):
+        """
+        Generates the blocks of a plain transfer.
+        
+        :param input_file: File object of the file to transfer.
+        :param digest: :py:class:`_ImageDigest` to update with the data read.
+        """
+        for block in iter(lambda: input_file.read(self._BLOCK_SIZE), ""):
+            digest.update(block)
+            yield block
+    
+    def _compress_blocks(self, input_file, digest):
+        """
+        Generates the blocks of a compressed transfer by streaming the file through the compressor.
+        
+        :param input_file: File object of the file to transfer.
+        :param digest: :py:class:`_ImageDigest` to update with the data read.
+        """
+        compressor = zlib.compressobj(self._compression_level)
+        buffer = ""
+        for data in iter(lambda: input_file.read(self._BLOCK_SIZE), ""):
+            digest.update(data)
+            buffer += compressor.compress(data)
+            while len(buffer) >= self._BLOCK_SIZE:
+                yield buffer[:self._BLOCK_SIZE]
+                buffer = buffer[self._BLOCK_SIZE:]
+        
+        buffer += compressor.flush()
+        for i in range(0, len(buffer), self._BLOCK_SIZE):
+            yield buffer[i:i + self._BLOCK_SIZE]
+    
+    def _delta_header(self, filename, size, changed_blocks):
+        """
+        Builds the header of a delta transfer as described in :py:meth:`set_delta`.
+        
+        :param filename: Filename of the file to transfer.
+        :param size: Size of the file to transfer.
+        :param changed_blocks: Indices of the blocks to transfer.
+        """
+        header = "%s\0%d %d %d\0" % (os.path.basename(filename), size, self._BLOCK_SIZE, len(changed_blocks))
+        header += struct.pack(">%dI" % (len(changed_blocks)), *[i * self._BLOCK_SIZE for i in changed_blocks])
+        if len(header) % self._BLOCK_SIZE:
+            header += self._PADDING_BYTE * (self._BLOCK_SIZE - len(header) % self._BLOCK_SIZE)
+        return header
+    
+    def _delta_blocks(self, input_file, header, changed_blocks):
+        """
+        Generates the blocks of a delta transfer by reading only the changed blocks from the file.
+        
+        :param input_file: File object of the file to transfer.
+        :param header: Header of the delta transfer.
+        :param changed_blocks: Indices of the blocks to transfer.
+        """
+        for i in range(0, len(header), self._BLOCK_SIZE):
+            yield header[i:i + self._BLOCK_SIZE]
+        
+        for i in changed_blocks:
+            input_file.seek(i * self._BLOCK_SIZE)
+            yield input_file.read(self._BLOCK_SIZE)
+    
+    def _cache_manifest(self, manifest):
+        """
+        Caches the manifest of the image now held by the receiver.
+        
+        A manifest which cannot be written does not fail the completed transfer. The stale manifest is removed instead so that the next transfer falls back to a full transfer rather than patching against the wrong image.
+        
+        :param manifest: Manifest of the transferred file.
+        """
+        try:
+            manifest.save(self._manifest_filename)
+        except ConfigurationException:
+            try:
+                os.remove(self._manifest_filename)
+            except OSError:
+                pass
     
     def _transmit_block(self, block_index, block):
         """
@@ -350,6 +1085,11 @@ class Main:
     }
     
     _tx_filename = None
+    _trace_filename = None
+    _replay_filename = None
+    _replay_scale = 1.0
+    _compression_level = None
+    _manifest_filename = None
         
     def __init__(self):
         """
@@ -393,6 +1133,13 @@ class Main:
 
     Transfer:
       -f, --file    specify the file that will be transfered
+      -z, --compress offer a compressed transfer at the specified zlib level
+      -d, --delta   offer a delta transfer against the specified manifest file
+
+    Diagnostics:
+      -r, --record  record the session to the specified trace file
+      -R, --replay  replay the receiver side of the specified trace file
+      -s, --scale   specify the factor applied to replayed latencies
      '''
     
     def _callback_initialized(self):
@@ -410,7 +1157,7 @@ class Main:
         """
         # scan arguments for options    
         try:
-            opts, args = getopt.getopt(sys.argv[1:], "?lp:b:t:f:", ["help", "list", "port=", "baud=", "timeout=", "file="])
+            opts, args = getopt.getopt(sys.argv[1:], "?lp:b:t:f:z:d:r:R:s:", ["help", "list", "port=", "baud=", "timeout=", "file=", "compress=", "delta=", "record=", "replay=", "scale="])
         except getopt.GetoptError, err:
             print str(err)
             return self._EXIT_ERROR
@@ -442,15 +1189,40 @@ class Main:
                     return self._EXIT_ERROR 
             elif o in ("-f", "--file"):
                 self._tx_filename = a
+            elif o in ("-z", "--compress"):
+                try:
+                    self._compression_level = int(a)
+                except ValueError:
+                    print "[ERROR] Invalid compression level '%s' specified." % (a)
+                    return self._EXIT_ERROR 
+            elif o in ("-d", "--delta"):
+                self._manifest_filename = a
+            elif o in ("-r", "--record"):
+                self._trace_filename = a
+            elif o in ("-R", "--replay"):
+                self._replay_filename = a
+            elif o in ("-s", "--scale"):
+                try:
+                    self._replay_scale = float(a)
+                except ValueError:
+                    print "[ERROR] Invalid replay scale '%s' specified." % (a)
+                    return self._EXIT_ERROR 
                 
         try:
-            tx_object = TXMODEM.from_configuration(**self._configuration)
+            if self._replay_filename is not None:
+                tx_object = TXMODEM.from_serial(ReplaySerial(self._replay_filename, self._replay_scale))
+            else:
+                tx_object = TXMODEM.from_configuration(**self._configuration)
+            tx_object.record(self._trace_filename)
+            tx_object.set_compression(self._compression_level)
+            tx_object.set_delta(self._manifest_filename)
             
             tx_object.add_callback(TXMODEM.EVENT_INITIALIZATION, self._callback_initialized)
             tx_object.add_callback(TXMODEM.EVENT_BLOCK_SENT, self._callback_block_sent)
             tx_object.add_callback(TXMODEM.EVENT_TERMIATION, self._callback_terminated)
             
-            tx_object.send(self._tx_filename)
+            result = tx_object.send(self._tx_filename)
+            print "Transferred %d bytes with CRC-32 %08x and SHA-256 %s." % (result["size"], result["crc32"], result["sha256"])
         except(ConfigurationException, CommunicationException) as ex:
             print "[ERROR] %s" %(ex)        
         except(KeyboardInterrupt, SystemExit):